@@ -0,0 +1,238 @@
+import functools
+import hashlib
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import tempfile
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+if TYPE_CHECKING:
+    from ppcgrader.compiler import Compiler
+
+
+HASH_CHUNK = 1 << 20  # Bytes
+
+
+def _new_hash():
+    # The key only needs to detect changes in the user's own files, so a fast
+    # non-cryptographic hash is enough
+    if xxhash is not None:
+        return xxhash.xxh3_64()
+    else:
+        return hashlib.blake2b(digest_size=16)
+
+
+# Fields of /proc/cpuinfo that identify the instruction set of the CPU, on
+# x86 and on ARM
+_CPUINFO_FIELDS = {
+    'vendor_id', 'cpu family', 'model', 'model name', 'flags',
+    'CPU implementer', 'CPU architecture', 'CPU variant', 'CPU part',
+    'Features'
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _host_cpu() -> Optional[List[str]]:
+    """
+    Identifies the CPU of this machine, or returns None if it is not known
+    """
+    try:
+        with open('/proc/cpuinfo') as f:
+            fields = []
+            for line in f:
+                # The fields of the first processor are enough
+                if not line.strip():
+                    break
+                name, _, value = line.partition(':')
+                if name.strip() in _CPUINFO_FIELDS:
+                    fields.append(f'{name.strip()}:{value.strip()}')
+            if fields:
+                return [platform.machine(), *fields]
+    except OSError:
+        pass
+
+    if platform.system() == 'Darwin':
+        try:
+            brand = subprocess.run(
+                ['sysctl', '-n', 'machdep.cpu.brand_string'],
+                timeout=10,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True)
+            if brand.returncode == 0 and brand.stdout.strip():
+                return [platform.machine(), brand.stdout.strip()]
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+
+    return None
+
+
+def compute_key(compiler: 'Compiler', out_file: str) -> Optional[str]:
+    """
+    Computes a key that changes whenever compiling with `compiler` into
+    `out_file` is done differently: the compiler itself, the full command
+    line, or the CPU that -march=native targets. The files read by the
+    compilation are checked separately, see `write`.
+
+    Returns None if the build must not be reused at all.
+    """
+    h = _new_hash()
+    command = compiler.compile_command(out_file)
+    entries = [command]
+
+    program = shutil.which(compiler.program)
+    if program is not None:
+        st = os.stat(program)
+        entries.append([program, st.st_size, st.st_mtime_ns])
+    entries.append(getattr(compiler, 'version', None))
+
+    # A binary built for the CPU of one machine may not run on another one,
+    # for example with a home directory shared between machines
+    if any('=native' in arg for arg in command):
+        host = _host_cpu()
+        if host is None:
+            return None
+        entries.append(host)
+
+    h.update(json.dumps(entries).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _hash_files(files: List[str]) -> str:
+    h = _new_hash()
+    for file in files:
+        with open(file, 'rb') as f:
+            # Include the size so that moving bytes between a file name
+            # and the contents of the previous file changes the hash
+            h.update(b'\0%s\0%d\0' %
+                     (file.encode('utf-8', errors='surrogateescape'),
+                      os.fstat(f.fileno()).st_size))
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+# A file name in a Makefile rule: spaces and other special characters are
+# escaped with a backslash
+_DEPFILE_TOKEN_RE = re.compile(r'(?:\\.|\S)+')
+_DEPFILE_ESCAPE_RE = re.compile(r'\\([ #])')
+
+
+def read_depfile(path: str) -> List[str]:
+    """
+    Lists the files named in a dependency file written by the compiler with
+    -MD -MF, that is, the source and every header it includes.
+    """
+    with open(path, encoding='utf-8', errors='surrogateescape') as f:
+        text = f.read()
+    files = []
+    for line in re.sub(r'\\\r?\n', ' ', text).splitlines():
+        # Each rule is of the form "target: dependencies..."
+        _, sep, dependencies = line.partition(': ')
+        if not sep:
+            continue
+        for token in _DEPFILE_TOKEN_RE.findall(dependencies):
+            files.append(
+                _DEPFILE_ESCAPE_RE.sub(r'\1', token).replace('$$', '$'))
+    return files
+
+
+# The stamp is preferably stored as an extended attribute of the built file
+# itself, so that it disappears together with the file. Where extended
+# attributes are not supported, a sidecar file is used instead.
+STAMP_XATTR = 'user.ppcgrader.build_stamp'
+
+
+def _stamp_file(out_file: str) -> str:
+    return out_file + '.stamp'
+
+
+def _binary_state(out_file: str) -> List[int]:
+    st = os.stat(out_file)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _read_stamp(out_file: str) -> bytes:
+    try:
+        return os.getxattr(out_file, STAMP_XATTR)
+    except (AttributeError, OSError):
+        pass
+    with open(_stamp_file(out_file), 'rb') as f:
+        return f.read()
+
+
+def fresh_output(out_file: str, key: str) -> Optional[Tuple[str, str]]:
+    """
+    Checks whether `out_file` was built with the given key from files that
+    have not changed since. If so, returns the stdout and stderr of that
+    compilation.
+    """
+    try:
+        stamp = json.loads(_read_stamp(out_file))
+        if (stamp['key'] == key
+                and stamp['binary'] == _binary_state(out_file)
+                and stamp['hash'] == _hash_files(stamp['dependencies'])):
+            return stamp['stdout'], stamp['stderr']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def write(out_file: str, key: str, dependencies: List[str], stdout: str,
+          stderr: str):
+    """
+    Records that `out_file` was just built with the given key from the
+    `dependencies`, printing `stdout` and `stderr`
+    """
+    dependencies = list(dict.fromkeys(dependencies))
+    stamp = json.dumps({
+        'key': key,
+        'binary': _binary_state(out_file),
+        'dependencies': dependencies,
+        'hash': _hash_files(dependencies),
+        'stdout': stdout,
+        'stderr': stderr,
+    }).encode('utf-8')
+    try:
+        os.setxattr(out_file, STAMP_XATTR, stamp)
+        _remove_stamp_file(out_file)
+        return
+    except (AttributeError, OSError):
+        # No extended attributes on this platform or file system, or the
+        # stamp is too large for one
+        pass
+
+    stamp_file = _stamp_file(out_file)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(stamp_file) or None,
+                               prefix=os.path.basename(stamp_file),
+                               suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(stamp)
+        os.replace(tmp, stamp_file)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _remove_stamp_file(out_file: str):
+    try:
+        os.remove(_stamp_file(out_file))
+    except OSError:
+        pass
+
+
+def remove(out_file: str):
+    try:
+        os.removexattr(out_file, STAMP_XATTR)
+    except (AttributeError, OSError):
+        pass
+    _remove_stamp_file(out_file)
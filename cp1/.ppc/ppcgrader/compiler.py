@@ -1,13 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import functools
 import math
+import os
+import shutil
+import selectors
 import subprocess
-from typing import List, Optional, Dict, Union
+import tempfile
+import time
+from typing import List, Optional, Dict, Sequence, Tuple, Union
 import re
 import copy
 from ppcgrader.logging import log_command
+from ppcgrader.compiler_probe import ProbeRecord, probe, which
+from ppcgrader import build_stamp
 import platform
 import sys
 
 MAX_COMPILER_OUTPUT = 30000  # Characters
+COMPILER_READ_CHUNK = 65536  # Bytes
 MIN_GCC, MAX_GCC = 8, 15
 MIN_CLANG, MAX_CLANG = 6, 20
 
@@ -15,6 +26,132 @@ GCC_BINARIES = ['g++'] + [f"g++-{v}" for v in range(MIN_GCC, MAX_GCC + 1)]
 CLANG_BINARIES = ['clang++'] + \
     [f"clang++-{v}" for v in range(MIN_CLANG, MAX_CLANG + 1)]
 NVCC_BINARIES = ['nvcc']
+COMPILER_CACHE_BINARIES = ['sccache', 'ccache']
+
+_GCC_COMMON_FLAGS = (
+    '-std=c++2a',
+    '-Wall',
+    '-Wextra',
+    '-Wvla',
+    '-Werror',
+    '-Wno-error=unknown-pragmas',
+    '-Wno-error=unused-but-set-variable',
+    '-Wno-error=unused-local-typedefs',
+    '-Wno-error=unused-function',
+    '-Wno-error=unused-label',
+    '-Wno-error=unused-value',
+    '-Wno-error=unused-variable',
+    '-Wno-error=unused-parameter',
+    '-Wno-error=unused-but-set-parameter',
+    '-Wno-psabi',
+    '-march=native',
+    '-fdiagnostics-color=never',
+)
+_CLANG_COMMON_FLAGS = (
+    '-std=c++2a',
+    '-Wall',
+    '-Wextra',
+    '-Wvla',
+    '-Werror',
+    '-Wno-unknown-warning-option',
+    '-Wno-error=unknown-pragmas',
+    '-Wno-error=unused-but-set-variable',
+    '-Wno-error=unused-local-typedefs',
+    '-Wno-error=unused-function',
+    '-Wno-error=unused-label',
+    '-Wno-error=unused-value',
+    '-Wno-error=unused-variable',
+    '-Wno-error=unused-parameter',
+    '-Wno-error=unused-but-set-parameter',
+    '-march=native',
+)
+_NVCC_COMMON_FLAGS = (
+    '-std=c++17',
+    '--Werror',
+    'cross-execution-space-call',
+    '-Xptxas',
+    '--warn-on-spills',
+    '-Xcompiler',
+    '"-Wall"',
+    '-Xcompiler',
+    '"-Wextra"',
+    '-Xcompiler',
+    '"-Werror"',
+    '-Xcompiler',
+    '"-Wno-error=unknown-pragmas"',
+    '-Xcompiler',
+    '"-Wno-error=unused-local-typedefs"',
+    '-Xcompiler',
+    '"-Wno-error=unused-function"',
+    '-Xcompiler',
+    '"-Wno-error=unused-label"',
+    '-Xcompiler',
+    '"-Wno-error=unused-value"',
+    '-Xcompiler',
+    '"-Wno-error=unused-variable"',
+    '-Xcompiler',
+    '"-Wno-error=unused-parameter"',
+    '-Xcompiler',
+    '"-Wno-psabi"',
+    '-Xcompiler',
+    '"-march=native"',
+)
+
+# Versions in the output of compiler --version
+_VER_RE = re.compile(r'(\d+)\.(\d+)\.(\d+)')
+# Warning options of the recognized compile errors, and the types of errors
+# they are reported as. [-Werror=vla] is for gcc, the other vla one for clang.
+_DIAG_TYPES = {
+    'error=vla': 'Wvla',
+    'error,-Wvla-extension': 'Wvla',
+    'unknown-pragmas': 'omp',
+}
+_DIAG_RE = re.compile(
+    r'\[-W(error=vla|error,-Wvla-extension|unknown-pragmas)\]')
+_NEWLINE_RE = re.compile(r'\r\n|[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]')
+
+
+@functools.lru_cache(maxsize=None)
+def _list_predefined_macros(args: Tuple[str, ...]) -> Optional[str]:
+    """
+    Runs the preprocessor command `args` to list the predefined macros of a
+    compiler, or returns None if it fails. The OpenMP support and validity
+    checks run the same command for the same binaries, so the results are
+    cached.
+    """
+    log_command(list(args), 2)
+    output = subprocess.run(args,
+                            input='',
+                            timeout=10,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            encoding='utf-8',
+                            errors='utf-8')
+    if output.returncode != 0:
+        return None
+    return output.stdout
+
+
+@functools.lru_cache(maxsize=None)
+def _version_banner(program: str) -> Optional[str]:
+    """
+    Returns the first line printed by `program --version`, or None if it
+    fails. The gcc and clang probes try the same binaries, so the results are
+    cached.
+    """
+    args = [program, '--version']
+    log_command(args, 2)
+    output = subprocess.run(args,
+                            stdin=subprocess.DEVNULL,
+                            timeout=10,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            encoding='utf-8',
+                            errors='utf-8')
+    if output.returncode != 0:
+        return None
+    lines = output.stdout.splitlines()
+    return lines[0] if lines else ''
 
 
 class CompilerOutput:
@@ -27,56 +164,132 @@ class CompilerOutput:
         return self.returncode == 0
 
 
-def _check_vla_error(text: str) -> bool:
-    # [-Werror=vla] is for gcc, the other for clang
-    return "[-Werror=vla]" in text or "[-Werror,-Wvla-extension]" in text
-
-
-def _check_omp_pragma_error(text: str) -> bool:
-    return "[-Wunknown-pragmas]" in text and "omp" in text
+class _BoundedSink:
+    """
+    Collects the output of a compiler, keeping only what is needed for its
+    first `limit` characters. The output is decoded only once, at the end.
+    """
+    def __init__(self, limit: int):
+        self.limit = max(0, limit)
+        self.data = bytearray()
+
+    def feed(self, chunk: bytes):
+        # A character takes at most 4 bytes in UTF-8
+        room = 4 * self.limit - len(self.data)
+        if room > 0:
+            self.data += chunk[:room]
+
+    def result(self) -> str:
+        text = self.data.decode('utf-8', errors='replace')[:self.limit]
+        # Translate newlines like the text mode of subprocess does
+        return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def _communicate(process: subprocess.Popen, stdout: _BoundedSink,
+                 stderr: _BoundedSink, deadline: Optional[float]) -> int:
+    """
+    Feeds the output of `process` to the sinks until it exits, and returns
+    its exit code. Raises subprocess.TimeoutExpired when the deadline passes.
+    """
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ, stdout)
+        selector.register(process.stderr, selectors.EVENT_READ, stderr)
+        while selector.get_map():
+            remaining = (deadline - time.monotonic()
+                         if deadline is not None else None)
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired(process.args, 0)
+            for key, _ in selector.select(remaining):
+                chunk = os.read(key.fd, COMPILER_READ_CHUNK)
+                if chunk:
+                    key.data.feed(chunk)
+                else:
+                    selector.unregister(key.fileobj)
+    return process.wait(timeout=max(0, deadline - time.monotonic())
+                        if deadline is not None else None)
 
 
 def analyze_compile_errors(stderr: str) -> List[Dict[str, Union[str, int]]]:
+    # All of the recognized diagnostics name a warning option like [-W...], so
+    # the whole output can usually be skipped quickly
+    if "[-W" not in stderr:
+        return []
+
+    # Line breaks are the same as in str.splitlines()
+    breaks = list(_NEWLINE_RE.finditer(stderr))
+    line_ends = [m.start() for m in breaks]
+    # Types of the errors found on each line, at most one of each type
+    found: Dict[int, List[str]] = {}
+    for match in _DIAG_RE.finditer(stderr):
+        line = bisect.bisect_left(line_ends, match.start())
+        error_type = _DIAG_TYPES[match.group(1)]
+        if error_type == 'omp':
+            # Only unknown OpenMP pragmas are interesting
+            start = breaks[line - 1].end() if line > 0 else 0
+            end = line_ends[line] if line < len(line_ends) else len(stderr)
+            if 'omp' not in stderr[start:end]:
+                continue
+        types = found.setdefault(line, [])
+        if error_type not in types:
+            types.append(error_type)
+
     errors = []
-    lines = stderr.splitlines()
-    for i in range(len(lines)):
-        if _check_vla_error(lines[i]):
-            errors.append({
-                'type': 'Wvla',
-                'line': i,
-            })
-        if _check_omp_pragma_error(lines[i]):
-            errors.append({
-                'type': 'omp',
-                'line': i,
-            })
+    for line in sorted(found):
+        for error_type in ('Wvla', 'omp'):
+            if error_type in found[line]:
+                errors.append({
+                    'type': error_type,
+                    'line': line,
+                })
     return errors
 
 
 class Compiler:
-    def __init__(self, program: str, common_flags: List[str]):
+    # Whether the compiler writes dependency files with -MD -MF, which is
+    # needed for reusing previous builds
+    writes_depfiles = True
+
+    def __init__(self, program: str, common_flags: Sequence[str]):
         self.sources = []
         self.flags = []
         self.libs = []
         self.program = program
-        self.common_flags = common_flags
+        self.common_flags = list(common_flags)
+        self.cache = None
+
+    def _copy(self) -> 'Compiler':
+        # Only the lists are modified by the builder methods, and everything
+        # else is immutable, so there is no need for a full deepcopy
+        me = copy.copy(self)
+        me.sources = list(self.sources)
+        me.flags = list(self.flags)
+        me.libs = list(self.libs)
+        return me
 
     def add_source(self, file: str) -> 'Compiler':
-        me = copy.deepcopy(self)
-        me.sources.append(file)
-        return me
+        return self._copy().extend_sources(file)
 
     def add_library(self, lib: str) -> 'Compiler':
-        me = copy.deepcopy(self)
         if not lib.startswith("-l"):
             lib = f"-l{lib}"
-        me.libs.append(lib)
-        return me
+        return self._copy().extend_libs(lib)
 
     def add_flag(self, *flags: str) -> 'Compiler':
-        me = copy.deepcopy(self)
-        me.flags.extend(flags)
-        return me
+        return self._copy().extend_flags(*flags)
+
+    # In-place variants of the builder methods, for adding many arguments to a
+    # compiler that is known not to be shared
+    def extend_sources(self, *files: str) -> 'Compiler':
+        self.sources.extend(files)
+        return self
+
+    def extend_flags(self, *flags: str) -> 'Compiler':
+        self.flags.extend(flags)
+        return self
+
+    def extend_libs(self, *libs: str) -> 'Compiler':
+        self.libs.extend(libs)
+        return self
 
     def add_omp_flags(self) -> 'Compiler':
         return self.add_flag('-fopenmp')
@@ -87,60 +300,167 @@ class Compiler:
         :param name: Name of the macro to define
         :param value: Value to assign to the macro. Can be None, in which case the macro is defined without a value.
         """
-        if value is None:
-            return self.add_flag(f'-D{name}')
-        else:
-            return self.add_flag(f'-D{name}={value}')
+        return self.add_definitions(**{name: value})
+
+    def add_definitions(self, **definitions: Optional) -> 'Compiler':
+        """
+        Adds several preprocessor definitions to the compiler arguments at once.
+        :param definitions: Values of the macros to define by name. See add_definition.
+        """
+        return self.add_flag(*(f'-D{name}' if value is None else
+                               f'-D{name}={value}'
+                               for name, value in definitions.items()))
+
+    def with_cache(self, cache: str) -> 'Compiler':
+        """
+        Runs the compilations through a compiler cache such as ccache or sccache.
+        :param cache: Path to the compiler cache executable
+        """
+        me = self._copy()
+        me.cache = cache
+        return me
+
+    def _launcher(self) -> List[str]:
+        return [self.cache] if self.cache is not None else []
 
-    def compile_command(self, out_file: str = 'a.out') -> List[str]:
-        return [self.program
-                ] + self.common_flags + self.flags + self.sources + [
-                    '-o', out_file
-                ] + self.libs
+    @staticmethod
+    def _depfile_flags(depfile: Optional[str]) -> List[str]:
+        # List the files read by the compilation, including every header,
+        # without a separate preprocessing pass
+        return ['-MD', '-MF', depfile] if depfile is not None else []
+
+    def compile_command(self,
+                        out_file: str = 'a.out',
+                        depfile: Optional[str] = None) -> List[str]:
+        return [
+            *self._launcher(), self.program, *self.common_flags, *self.flags,
+            *self._depfile_flags(depfile), *self.sources, '-o', out_file,
+            *self.libs
+        ]
+
+    def object_command(self,
+                       source: str,
+                       out_file: str,
+                       depfile: Optional[str] = None) -> List[str]:
+        return [
+            *self._launcher(), self.program, *self.common_flags, *self.flags,
+            *self._depfile_flags(depfile), '-c', source, '-o', out_file
+        ]
+
+    def link_command(self,
+                     objects: List[str],
+                     out_file: str = 'a.out') -> List[str]:
+        return [
+            self.program, *self.common_flags, *self.flags, *objects, '-o',
+            out_file, *self.libs
+        ]
 
     def compile(self,
                 out_file: str = 'a.out',
                 timeout: float = 10) -> CompilerOutput:
-        args = self.compile_command(out_file)
-        logged = log_command(args)
         # subprocess.run cannot handle infinite timeouts, needs explicit None
         if timeout is None or not math.isfinite(timeout):
             timeout = None
 
-        try:
-            result = subprocess.run(args,
-                                    timeout=timeout,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    encoding='utf-8',
-                                    errors='utf-8')
-            output = CompilerOutput(result.stdout[:MAX_COMPILER_OUTPUT],
-                                    result.stderr[:MAX_COMPILER_OUTPUT],
-                                    result.returncode)
-        except subprocess.TimeoutExpired:
-            output = CompilerOutput(
-                '',
-                f'Compilation process took longer than {timeout}s, killed the process',
-                -1)
+        # Skip the compilation entirely if out_file was already built from
+        # exactly the same inputs
+        key = None
+        if self.writes_depfiles:
+            try:
+                key = build_stamp.compute_key(self, out_file)
+            except OSError:
+                pass
+        if key is not None:
+            previous = build_stamp.fresh_output(out_file, key)
+            if previous is not None:
+                return CompilerOutput(*previous, 0)
+        build_stamp.remove(out_file)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Without a key, no dependency files are needed
+            depfiles = [
+                os.path.join(tmp_dir, f'{i}.d') if key is not None else None
+                for i in range(len(self.sources))
+            ]
+            if len(self.sources) > 1 and (key is not None
+                                          or self.cache is not None):
+                # The compiler writes the dependencies of only one source file
+                # into a dependency file, and compiler caches can only cache
+                # compilations of a single source file. So compile each source
+                # file separately and link them afterwards. This way e.g. the
+                # unchanged tester is never recompiled.
+                objects = [
+                    os.path.join(tmp_dir, f'{i}.o')
+                    for i in range(len(self.sources))
+                ]
+                steps = [
+                    self.object_command(source, obj, depfile) for source, obj,
+                    depfile in zip(self.sources, objects, depfiles)
+                ]
+                steps.append(self.link_command(objects, out_file))
+            else:
+                depfiles = depfiles[:1]
+                steps = [self.compile_command(out_file, *depfiles)]
+            output = self._run_steps(steps, timeout)
+
+            if key is not None and output.is_success():
+                try:
+                    dependencies = []
+                    for depfile in depfiles:
+                        dependencies += build_stamp.read_depfile(depfile)
+                    build_stamp.write(out_file, key, dependencies,
+                                      output.stdout, output.stderr)
+                except OSError:
+                    pass
+
+        if self.cache is not None:
+            stats_command = [self.cache, '--show-stats']
+            if log_command(stats_command, 2):
+                subprocess.run(stats_command)
+
+        return output
 
-        if not logged and not output.is_success():
-            log_command(args, 0)
+    def _run_steps(self, steps: List[List[str]],
+                   timeout: Optional[float]) -> CompilerOutput:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        stdout = ''
+        stderr = ''
+        for args in steps:
+            logged = log_command(args)
+            # Only the beginning of the output is kept, however much the
+            # compiler prints
+            stdout_sink = _BoundedSink(MAX_COMPILER_OUTPUT - len(stdout))
+            stderr_sink = _BoundedSink(MAX_COMPILER_OUTPUT - len(stderr))
+            with subprocess.Popen(args,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE) as process:
+                try:
+                    returncode = _communicate(process, stdout_sink,
+                                              stderr_sink, deadline)
+                    stdout += stdout_sink.result()
+                    stderr += stderr_sink.result()
+                    output = CompilerOutput(stdout, stderr, returncode)
+                except subprocess.TimeoutExpired:
+                    # Don't wait for the pipes to close, as they may be kept
+                    # open by the children of the killed compiler
+                    process.kill()
+                    output = CompilerOutput(
+                        '',
+                        f'Compilation process took longer than {timeout}s, killed the process',
+                        -1)
+
+            if not logged and not output.is_success():
+                log_command(args, 0)
+
+            if not output.is_success():
+                break
 
         return output
 
     def is_valid(self, args: Optional[List[str]] = None) -> bool:
         try:
-            args = args if args else [
-                self.program, '-dM', '-fopenmp', '-E', '-'
-            ]
-            log_command(args, 2)
-            return subprocess.run(args,
-                                  input='',
-                                  timeout=10,
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE,
-                                  encoding='utf-8',
-                                  errors='utf-8').returncode == 0
+            args = args if args else self._openmp_probe_args()
+            return _list_predefined_macros(tuple(args)) is not None
         except AssertionError:
             return False
         except FileNotFoundError:
@@ -163,37 +483,30 @@ Check that the compiler is working by, for example, running:
             sys.exit(
                 'Testing compiler took too much time, killed the process.')
 
+    def _openmp_probe_args(self) -> List[str]:
+        return [self.program, '-dM', '-fopenmp', '-E', '-']
+
+    def supports_openmp(self) -> bool:
+        listing = _list_predefined_macros(tuple(self._openmp_probe_args()))
+        return listing is not None and '_OPENMP' in listing
+
     def __str__(self):
         return self.program
 
 
 class GccCompiler(Compiler):
     def __init__(self, program: str = 'g++'):
-        self.version = GccCompiler.__get_version(program)
-
-        super().__init__(program=program,
-                         common_flags=[
-                             '-std=c++2a',
-                             '-Wall',
-                             '-Wextra',
-                             '-Wvla',
-                             '-Werror',
-                             '-Wno-error=unknown-pragmas',
-                             '-Wno-error=unused-but-set-variable',
-                             '-Wno-error=unused-local-typedefs',
-                             '-Wno-error=unused-function',
-                             '-Wno-error=unused-label',
-                             '-Wno-error=unused-value',
-                             '-Wno-error=unused-variable',
-                             '-Wno-error=unused-parameter',
-                             '-Wno-error=unused-but-set-parameter',
-                             '-Wno-psabi',
-                             '-march=native',
-                             '-fdiagnostics-color=never',
-                         ])
+        self.version = probe(
+            program, 'gcc',
+            lambda p: ProbeRecord('gcc', GccCompiler.__get_version(p))).version
+
+        super().__init__(program=program, common_flags=_GCC_COMMON_FLAGS)
 
     @staticmethod
     def __get_version(program: str):
+        # Most of the candidates don't exist, so don't spawn anything for them
+        if which(program) is None:
+            return None
         try:
             # currently the arm version of gcc from homebrew doesn't come with libasan and libubsan in which case we don't want to choose gcc
             if platform.system() == 'Darwin' and platform.machine() == 'arm64':
@@ -209,33 +522,15 @@ class GccCompiler(Compiler):
                                        stdout=subprocess.PIPE,
                                        stderr=subprocess.PIPE).returncode == 0)
 
-            args = [program, '-dM', '-fopenmp', '-E', '-']
-            log_command(args, 2)
-            output = subprocess.run(args,
-                                    input='',
-                                    timeout=10,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    encoding='utf-8',
-                                    errors='utf-8')
-            if output.returncode == 0:
-                lines = output.stdout.split('\n')
-                matches = [
-                    re.match('^#define (\\w+) (.*)$', line) for line in lines
-                ]
-                macros = {
-                    match.group(1): match.group(2)
-                    for match in matches if match is not None
-                }
-
-                if '__clang__' not in macros and '_OPENMP' in macros:
-                    # We don't want to choose clang in any case
-                    try:
-                        return (int(macros['__GNUC__']),
-                                int(macros['__GNUC_MINOR__']),
-                                int(macros['__GNUC_PATCHLEVEL__']))
-                    except TypeError:
-                        pass
+            banner = _version_banner(program)
+            # We don't want to choose clang in any case, even if it is
+            # installed as g++
+            if banner is not None and 'clang' not in banner:
+                # The version is the last one in the banner, as in
+                # "g++ (Debian 12.2.0-14) 12.2.0"
+                versions = _VER_RE.findall(banner)
+                if versions:
+                    return tuple(int(v) for v in versions[-1])
 
         except FileNotFoundError:
             pass
@@ -252,26 +547,12 @@ class GccCompiler(Compiler):
 
 class ClangCompiler(Compiler):
     def __init__(self, program: str = 'clang++'):
-        self.version, self.apple = ClangCompiler.__get_version(program)
-
-        flags = [
-            '-std=c++2a',
-            '-Wall',
-            '-Wextra',
-            '-Wvla',
-            '-Werror',
-            '-Wno-unknown-warning-option',
-            '-Wno-error=unknown-pragmas',
-            '-Wno-error=unused-but-set-variable',
-            '-Wno-error=unused-local-typedefs',
-            '-Wno-error=unused-function',
-            '-Wno-error=unused-label',
-            '-Wno-error=unused-value',
-            '-Wno-error=unused-variable',
-            '-Wno-error=unused-parameter',
-            '-Wno-error=unused-but-set-parameter',
-            '-march=native',
-        ]
+        record = probe(
+            program, 'clang',
+            lambda p: ProbeRecord('clang', *ClangCompiler.__get_version(p)))
+        self.version, self.apple = record.version, record.apple
+
+        flags = list(_CLANG_COMMON_FLAGS)
         if platform.system() == 'Darwin' and platform.machine() == 'arm64':
             flags = flags[:-1]
 
@@ -282,40 +563,19 @@ class ClangCompiler(Compiler):
 
     @staticmethod
     def __get_version(program: str):
+        if which(program) is None:
+            return [None, None]
         try:
-            args = [program, '-dM', '-fopenmp', '-E', '-']
-            if platform.system() == 'Darwin':
-                args = [
-                    program, '-dM', '-Xpreprocessor', '-fopenmp', '-E', '-'
-                ]
-            log_command(args, 2)
-            output = subprocess.run(args,
-                                    input='',
-                                    timeout=10,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    encoding='utf-8',
-                                    errors='utf-8')
-            if output.returncode == 0:
-                lines = output.stdout.split('\n')
-                matches = [
-                    re.match('^#define (\\w+) (.*)$', line) for line in lines
-                ]
-                macros = {
-                    match.group(1): match.group(2)
-                    for match in matches if match is not None
-                }
-                try:
-                    apple = True if 'Apple' in macros['__VERSION__'] else False
-                except:
-                    apple = None
-                if '__clang__' in macros and '_OPENMP' in macros:
-                    try:
-                        return [(int(macros['__clang_major__']),
-                                 int(macros['__clang_minor__']),
-                                 int(macros['__clang_patchlevel__'])), apple]
-                    except TypeError:
-                        pass
+            banner = _version_banner(program)
+            if banner is not None and 'clang' in banner:
+                # The version is the first one in the banner, as in
+                # "Apple clang version 15.0.0 (clang-1500.1.0.2.5)"
+                match = _VER_RE.search(banner)
+                if match is not None:
+                    return [
+                        tuple(int(v) for v in match.groups()),
+                        'Apple' in banner
+                    ]
 
         except FileNotFoundError:
             pass
@@ -327,18 +587,19 @@ class ClangCompiler(Compiler):
     def __repr__(self):
         return f'Clang compiler ({self.program})'
 
+    def link_command(self,
+                     objects: List[str],
+                     out_file: str = 'a.out') -> List[str]:
+        # Clang warns about the compilation flags that are unused when only
+        # linking, and -Werror would turn these into errors
+        args = super().link_command(objects, out_file)
+        return args[:1] + ['-Qunused-arguments'] + args[1:]
+
     def add_omp_flags(self) -> 'Compiler':
         # Apple clang doesn't have openmp compiled so we want to include the homebrew package.
         if platform.system() == 'Darwin':
-            try:
-                brew_dir_command = ['brew', '--prefix']
-                log_command(brew_dir_command)
-                brew_dir = subprocess.run(brew_dir_command,
-                                          timeout=10,
-                                          stdout=subprocess.PIPE,
-                                          stderr=subprocess.PIPE,
-                                          encoding='utf-8').stdout.strip()
-            except FileNotFoundError:
+            brew_dir = _brew_prefix()
+            if brew_dir is None:
                 message = '''It seems that you don't have Homebrew installed.
 It is needed if you want to run OpenMP tasks on macOS.
 It would be great if you could install Homebrew from:
@@ -361,16 +622,7 @@ Or alternatively you can try to install GCC and use it instead of Clang:
 I should be able to find the right packages and compilers then!'''
                 sys.exit(message)
 
-            try:
-                brew_libomp_command = ['brew', 'list', 'libomp']
-                log_command(brew_libomp_command)
-                assert (subprocess.run(brew_libomp_command,
-                                       timeout=10,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE).returncode == 0)
-            except subprocess.TimeoutExpired:
-                print('Could not check required packages. Continuing...')
-            except AssertionError:
+            if _has_libomp(brew_dir) is False:
                 message = '''It seems that you have got Homebrew installed, which is great!
 However, it seems you do not have the libomp package installed.
 This is needed if you want to use OpenMP with the Clang C++ compiler.
@@ -402,100 +654,130 @@ I should be able to find the right packages and compilers then!'''
             #
             # Let's try to guess these paths based, and still keep the old paths
 
-            self = self.add_flag('-Xpreprocessor', '-fopenmp')
-            self = self.add_flag('-I', f'{brew_dir}/include')
-            self = self.add_flag('-I', f'{brew_dir}/opt/libomp/include')
+            self = self._copy()
+            self.extend_flags('-Xpreprocessor', '-fopenmp')
+            self.extend_flags('-I', f'{brew_dir}/include')
+            self.extend_flags('-I', f'{brew_dir}/opt/libomp/include')
             if sys.argv[1] != 'assembly':
-                self = self.add_flag('-lomp')
-                self = self.add_flag('-L', f'{brew_dir}/lib')
-                self = self.add_flag('-L', f'{brew_dir}/opt/libomp/lib')
+                # These are only needed when linking
+                self.extend_libs('-L', f'{brew_dir}/lib')
+                self.extend_libs('-L', f'{brew_dir}/opt/libomp/lib')
+                self.extend_libs('-lomp')
 
         else:
             self = self.add_flag('-fopenmp')
         return self
 
-    def is_valid(self) -> bool:
+    def _openmp_probe_args(self) -> List[str]:
         if platform.system() == 'Darwin':
-            return super().is_valid(
-                [self.program, '-dM', '-Xpreprocessor', '-fopenmp', '-E', '-'])
+            return [
+                self.program, '-dM', '-Xpreprocessor', '-fopenmp', '-E', '-'
+            ]
         else:
-            return super().is_valid()
+            return super()._openmp_probe_args()
 
 
 class NvccCompiler(Compiler):
+    # Older releases of nvcc don't support -MD -MF, and neither do all of the
+    # modes used for the assembly output, so builds are never reused
+    writes_depfiles = False
+
     def __init__(self, program: str = 'nvcc'):
-        super().__init__(program=program,
-                         common_flags=[
-                             '-std=c++17',
-                             '--Werror',
-                             'cross-execution-space-call',
-                             '-Xptxas',
-                             '--warn-on-spills',
-                             '-Xcompiler',
-                             '"-Wall"',
-                             '-Xcompiler',
-                             '"-Wextra"',
-                             '-Xcompiler',
-                             '"-Werror"',
-                             '-Xcompiler',
-                             '"-Wno-error=unknown-pragmas"',
-                             '-Xcompiler',
-                             '"-Wno-error=unused-local-typedefs"',
-                             '-Xcompiler',
-                             '"-Wno-error=unused-function"',
-                             '-Xcompiler',
-                             '"-Wno-error=unused-label"',
-                             '-Xcompiler',
-                             '"-Wno-error=unused-value"',
-                             '-Xcompiler',
-                             '"-Wno-error=unused-variable"',
-                             '-Xcompiler',
-                             '"-Wno-error=unused-parameter"',
-                             '-Xcompiler',
-                             '"-Wno-psabi"',
-                             '-Xcompiler',
-                             '"-march=native"',
-                         ])
+        super().__init__(program=program, common_flags=_NVCC_COMMON_FLAGS)
 
     def __repr__(self):
         return f'NVCC compiler ({self.program})'
 
     def add_omp_flags(self) -> 'Compiler':
-        self.common_flags += ['-Xcompiler', '-fopenmp']
-        return self
+        # common_flags is shared between copies, so it must not be modified
+        # in place
+        me = self._copy()
+        me.common_flags = self.common_flags + ['-Xcompiler', '-fopenmp']
+        return me
 
     def is_valid(self) -> bool:
         return super().is_valid(
             [self.program, '-Xcompiler', '-dM', '-x', 'cu', '-E', '-'])
 
 
-def find_gcc_compiler():
-    best = None
-    for program in GCC_BINARIES:
-        compiler = GccCompiler(program)
-        if compiler.version and compiler.version[0] >= MIN_GCC and (
-                best is None or best.version < compiler.version):
-            best = compiler
-    if best is not None:
-        return best
+@functools.lru_cache(maxsize=1)
+def _brew_prefix() -> Optional[str]:
+    """Returns the Homebrew installation directory, or None without Homebrew"""
+    try:
+        brew_dir_command = ['brew', '--prefix']
+        log_command(brew_dir_command)
+        return subprocess.run(brew_dir_command,
+                              timeout=10,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              encoding='utf-8').stdout.strip()
+    except FileNotFoundError:
+        return None
 
 
-def find_clang_compiler():
-    best = None
-    for program in CLANG_BINARIES + GCC_BINARIES:
-        compiler = ClangCompiler(program)
+@functools.lru_cache(maxsize=1)
+def _has_libomp(brew_dir: str) -> Optional[bool]:
+    """
+    Checks whether libomp is installed with Homebrew, or returns None if that
+    could not be checked
+    """
+    try:
+        brew_libomp_command = ['brew', 'list', 'libomp']
+        log_command(brew_libomp_command)
+        return subprocess.run(brew_libomp_command,
+                              timeout=10,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE).returncode == 0
+    except subprocess.TimeoutExpired:
+        print('Could not check required packages. Continuing...')
+        return None
 
-        if compiler.version and compiler.version[0] >= MIN_CLANG and (
-                best is None or best.version < compiler.version):
-            best = compiler
 
-    if best is not None:
-        return best
+@functools.lru_cache(maxsize=None)
+def find_compiler_cache() -> Optional[str]:
+    for program in COMPILER_CACHE_BINARIES:
+        cache = shutil.which(program)
+        if cache is not None:
+            return cache
+    return None
+
+
+def _probe_compilers(compiler_type, programs: List[str]) -> List[Compiler]:
+    # Probing is mostly waiting for the subprocesses, so run them concurrently
+    with ThreadPoolExecutor(max_workers=min(8, len(programs))) as executor:
+        return list(executor.map(compiler_type, programs))
+
+
+def _best_compiler(candidates: List[Compiler]) -> Optional[Compiler]:
+    # The first of the newest candidates is the best one. Checking for OpenMP
+    # support is slower than probing the version, so it is only done for the
+    # best candidates until one of them passes.
+    for compiler in sorted(candidates, key=lambda c: c.version, reverse=True):
+        if compiler.supports_openmp():
+            return compiler
+    return None
+
+
+def find_gcc_compiler():
+    return _best_compiler([
+        compiler for compiler in _probe_compilers(GccCompiler, GCC_BINARIES)
+        if compiler.version and compiler.version[0] >= MIN_GCC
+    ])
+
+
+def find_clang_compiler():
+    return _best_compiler([
+        compiler for compiler in _probe_compilers(
+            ClangCompiler, CLANG_BINARIES + GCC_BINARIES)
+        if compiler.version and compiler.version[0] >= MIN_CLANG
+    ])
 
 
 def find_nvcc_compiler():
     best = None
     for program in NVCC_BINARIES:
+        if which(program) is None:
+            continue
         try:
             log_command([program], 2)
             output = subprocess.run([program],
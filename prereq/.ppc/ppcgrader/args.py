@@ -1,14 +1,17 @@
 import argparse
+import os
 import sys
 from typing import Any, Optional, Sequence, Union, Dict, Type, List
 
 from ppcgrader.config import Config
 from ppcgrader.compiler import ClangCompiler, NvccCompiler, GccCompiler, find_gcc_compiler, find_clang_compiler, find_nvcc_compiler
 from ppcgrader.reporter import JsonReporter, TerminalReporter
-from ppcgrader.commands import Command, CommandFlavor, COMMANDS
+from ppcgrader.commands import Command, CommandFlavor, COMMANDS, TestMemcheckBatchCommand
 
 
-def expand_macro(command: str, gpu: bool) -> List[str]:
+def expand_macro(command: str,
+                 gpu: bool,
+                 batch_memcheck: bool = False) -> List[str]:
     command_macros = {'test': [], 'benchmark': []}
     command_macros['test'].append('test-asan')
     if not gpu:
@@ -30,6 +33,15 @@ def expand_macro(command: str, gpu: bool) -> List[str]:
         ]
     command_macros['test'].append('test-plain')
 
+    if batch_memcheck:
+        tools = TestMemcheckBatchCommand.tools
+        for macro in command_macros.values():
+            batched = [f'test-memcheck-{tool}' for tool in tools]
+            if all(c in macro for c in batched):
+                macro[macro.index(batched[0])] = TestMemcheckBatchCommand.name
+                for c in batched[1:]:
+                    macro.remove(c)
+
     expanded = (command_macros[command]
                 if command in command_macros else [command])
     return expanded
@@ -94,6 +106,32 @@ def nvcc_compiler(name):
     return compiler
 
 
+def parallel_jobs(value: str) -> int:
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(
+            f"Expected a positive number of parallel test runs, got {value}")
+    return jobs
+
+
+def default_parallel_jobs(config: Config, json: bool) -> int:
+    # The timeouts of the tests assume that they are run one at a time, and
+    # the JSON output is used for grading, so only run tests concurrently in
+    # interactive runs. Tests of OpenMP and GPU exercises already use the
+    # whole machine.
+    if json or config.openmp or config.gpu:
+        return 1
+    try:
+        # Respects the CPU affinity of e.g. a sandbox, unlike os.cpu_count()
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return max(1, cpus - 2)
+
+
 def remote_compiler(family: str):
     def compiler_passthrough(name: str):
         return (family, name)
@@ -351,6 +389,36 @@ def prepare_parser(config: Config, remote: bool = False):
         help='run through all tests without stopping at the first error',
     )
 
+    parser.add_argument(
+        '--parallel',
+        action='store',
+        dest='parallel',
+        metavar='N',
+        default=None,
+        help=
+        'run up to N tests at the same time (default: 1 with --json or for OpenMP and GPU exercises, otherwise the number of available CPUs minus two)',
+        type=parallel_jobs)
+
+    if config.gpu:
+        parser.add_argument(
+            '--batch-memcheck',
+            action='store_const',
+            dest='batch_memcheck',
+            default=False,
+            const=True,
+            help=
+            'compile once and run all the cuda-memcheck tools at the same time',
+        )
+
+    parser.add_argument(
+        '--ccache',
+        action=BooleanOptionalAction,
+        dest='ccache',
+        default=True,
+        help=
+        'compile through ccache or sccache when available, to avoid recompiling unchanged files',
+    )
+
     parser.add_argument(
         '-v',
         '--verbose',
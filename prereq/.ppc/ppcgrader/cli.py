@@ -7,7 +7,7 @@ import argparse
 import json
 import sys
 
-from ppcgrader.args import add_remote_argument, parse_args, clang_compiler, expand_macro, command_from_name, gcc_compiler, nvcc_compiler
+from ppcgrader.args import add_remote_argument, default_parallel_jobs, parse_args, clang_compiler, expand_macro, command_from_name, gcc_compiler, nvcc_compiler
 from ppcgrader.config import Config
 from ppcgrader.logging import set_log_level, set_log_color, set_log_enabled
 from ppcgrader.remote import exec_remote
@@ -148,10 +148,13 @@ def cli(config: Config):
 
     timeout = args.timeout
     no_timeout = args.no_timeout
+    # Only exists for GPU exercises
+    batch_memcheck = getattr(args, 'batch_memcheck', False)
 
     if args.query_timeout:
         total = 0
-        for command_name in expand_macro(args.command, config.gpu):
+        for command_name in expand_macro(args.command, config.gpu,
+                                         batch_memcheck):
             command = command_from_name(command_name, config)
             total += command.query_timeout(tests=tests,
                                            timeout=timeout,
@@ -165,6 +168,10 @@ def cli(config: Config):
     config.source = args.file
     config.binary = args.binary
     config.nvprof = args.nvprof
+    config.parallel = (args.parallel if args.parallel is not None else
+                       default_parallel_jobs(
+                           config, isinstance(reporter, JsonReporter)))
+    config.ccache = args.ccache
 
     config.ignore_errors = args.ignore_errors
 
@@ -172,7 +179,7 @@ def cli(config: Config):
     if isinstance(reporter, JsonReporter):
         set_log_enabled(False)
 
-    for command_name in expand_macro(args.command, config.gpu):
+    for command_name in expand_macro(args.command, config.gpu, batch_memcheck):
         command = command_from_name(command_name, config)
         passed = command.exec(compiler=compiler,
                               reporter=reporter,
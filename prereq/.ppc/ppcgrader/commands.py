@@ -1,16 +1,21 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import functools
 import subprocess
-from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+import fnmatch
 import glob
 import os
+import re
 import sys
+import threading
 
 from ppcgrader.config import Config
-from ppcgrader.runner import Runner, AsanRunner, TsanRunner, MemcheckRunner, NvprofRunner
-from ppcgrader.compiler import Compiler, GccCompiler, ClangCompiler, NvccCompiler, find_gcc_compiler, find_clang_compiler
+from ppcgrader.runner import Runner, RunnerOutput, AsanRunner, TsanRunner, MemcheckRunner, NvprofRunner
+from ppcgrader.compiler import Compiler, CompilerOutput, GccCompiler, ClangCompiler, NvccCompiler, find_gcc_compiler, find_clang_compiler
 from ppcgrader.reporter import Reporter
 
 MAX_ASSEMBLY_OUTPUT = 600000  # Bytes
+ASSEMBLY_READ_CHUNK = 65536  # Bytes
 
 
 class CommandFlavor:
@@ -111,26 +116,132 @@ class TestCommandBase(CompileAndRunCommandBase):
         if not output.is_success():
             return False
 
-        for test in tests:
-            runner_output = runner.run(self.config,
-                                       self.config.test_command(test),
-                                       timeout=parse_timeout(
-                                           test, timeout, no_timeout,
-                                           self.extra_timeout))
-            rep.result(test, runner_output)
-            if not self.config.ignore_errors:
-                if runner_output.errors or not runner_output.run_successful:
-                    return False
+        # Every test is an independent run of the compiled binary, so the
+        # tests are split evenly into shards that are run concurrently. Each
+        # shard runs its tests one after another, and the results are still
+        # reported in the order of the tests. Benchmarks are run alone, as
+        # other runs would distort their timings.
+        workers = min(len(tests),
+                      self.config.parallel if self.parallel_safe else 1)
+        results = [Future() for _ in tests]
+        timeouts = [
+            parse_timeout(test, timeout, no_timeout, self.extra_timeout)
+            for test in tests
+        ]
+        failure = FirstFailure()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for batch in _test_batches(tests, workers):
+                    for shard in batch:
+                        executor.submit(self._run_shard, runner, failure, [
+                            (i, tests[i], timeouts[i], results[i])
+                            for i in shard
+                        ])
+                    # Finish the batch before starting the next one
+                    for i in sorted(i for shard in batch for i in shard):
+                        test, runner_output = results[i].result()
+                        rep.result(test, runner_output)
+                        if self._stops_run(runner_output):
+                            return False
+            finally:
+                # Don't start the remaining tests if we stopped early
+                for pending in results:
+                    pending.cancel()
 
         return True
 
+    def _run_shard(
+            self, runner: Runner, failure: 'FirstFailure',
+            shard: List[Tuple[int, str, Optional[float], Future]]) -> None:
+        for index, test, timeout, result in shard:
+            # Tests after a failing one are never reported, so don't bother
+            # running them even if the failure hasn't been reported yet
+            if failure.is_before(index):
+                result.cancel()
+            # Skip the tests that were cancelled after an earlier failure
+            if not result.set_running_or_notify_cancel():
+                continue
+            try:
+                output = self._run_one(runner, test, timeout)
+            except BaseException as e:
+                result.set_exception(e)
+                continue
+            if self._stops_run(output[1]):
+                failure.record(index)
+            result.set_result(output)
+
+    def _stops_run(self, output: RunnerOutput) -> bool:
+        """Checks whether the remaining tests should be skipped after output"""
+        if self.config.ignore_errors:
+            return False
+        return bool(output.errors) or not output.run_successful
+
+    def _run_one(self, runner: Runner, test: str,
+                 timeout: Optional[float]) -> Tuple[str, RunnerOutput]:
+        return test, runner.run(self.config,
+                                self.config.test_command(test),
+                                timeout=timeout)
+
     # Hooks to modify the behavior of the command
     start_message = 'Running tests'
+    # specifies whether the tests can be run concurrently
+    parallel_safe = True
 
     def _init_runner(self) -> Runner:
         return Runner()
 
 
+def _is_benchmark(test: str) -> bool:
+    return os.path.basename(os.path.dirname(
+        os.path.abspath(test))) == 'benchmarks'
+
+
+def _shards(indices: List[int], workers: int) -> List[List[int]]:
+    count = min(len(indices), workers)
+    return [indices[i::count] for i in range(count)]
+
+
+def _test_batches(tests: List[str], workers: int) -> List[List[List[int]]]:
+    """
+    Groups the indices of `tests` into batches that are run one after
+    another. Each batch is a list of shards that are run concurrently.
+    Consecutive tests are split evenly into `workers` shards, but each
+    benchmark is a batch of its own.
+    """
+    batches = []
+    group = []
+    for i, test in enumerate(tests):
+        if _is_benchmark(test):
+            if group:
+                batches.append(_shards(group, workers))
+                group = []
+            batches.append([[i]])
+        else:
+            group.append(i)
+    if group:
+        batches.append(_shards(group, workers))
+    return batches
+
+
+class FirstFailure:
+    """
+    Keeps track of the first failing test in a group of tests that are run
+    concurrently, so that the tests after it can be skipped.
+    """
+    def __init__(self):
+        self.index: Optional[int] = None
+        self.lock = threading.Lock()
+
+    def record(self, index: int):
+        with self.lock:
+            if self.index is None or index < self.index:
+                self.index = index
+
+    def is_before(self, index: int) -> bool:
+        first = self.index
+        return first is not None and first < index
+
+
 class SmallTestCommandBase(TestCommandBase):
     def collect_tests(self, user_tests: List[str]) -> List[str]:
         tests = expand_glob(user_tests, ['tests/*'])
@@ -146,13 +257,14 @@ class TestPlainCommand(TestCommandBase):
 
     def _prepare_compiler(self, compiler: Compiler,
                           runner: AsanRunner) -> Compiler:
-        return compiler.add_flag('-O3').add_flag('-g')
+        return compiler.add_flag('-O3', '-g')
 
 
 class TestAsanCommand(SmallTestCommandBase):
     start_message = 'Running tests with address sanitizer'
     name = 'test-asan'
     help = 'run tests with address sanitizer'
+    parallel_safe = False
 
     def _init_runner(self) -> Runner:
         return AsanRunner()
@@ -171,19 +283,18 @@ class TestAsanCommand(SmallTestCommandBase):
             '-Og',
         ]
         if isinstance(compiler, NvccCompiler):
-            options = sum((['-Xcompiler', f'"{o}"'] for o in options), [])
+            options = [x for o in options for x in ('-Xcompiler', f'"{o}"')]
             runner.env[
                 'ASAN_OPTIONS'] = 'protect_shadow_gap=0:replace_intrin=0:detect_leaks=0'
 
-        compiler = compiler.add_flag(*options)
-        compiler = compiler.add_flag('-g').add_definition(
+        return compiler.add_flag(*options, '-g').add_definition(
             '_GLIBCXX_SANITIZE_VECTOR', '1')
-        return compiler
 
 
 class TestMemcheckCommandBase(TestCommandBase):
     flavor = CommandFlavor.GPU
     extra_timeout = 1.0
+    parallel_safe = False
 
     def __init__(self, config: Config, tool: str):
         self.tool = tool
@@ -205,8 +316,8 @@ class TestMemcheckCommandBase(TestCommandBase):
 
     def _prepare_compiler(self, compiler: Compiler,
                           runner: Runner) -> Compiler:
-        return compiler.add_flag('-O3').add_flag('-g').add_flag(
-            '-Xcompiler', '-rdynamic').add_flag('-lineinfo')
+        return compiler.add_flag('-O3', '-g', '-Xcompiler', '-rdynamic',
+                                 '-lineinfo')
 
 
 class TestMemcheckCommand(TestMemcheckCommandBase):
@@ -241,6 +352,102 @@ class TestSynccheckCommand(TestMemcheckCommandBase):
         super().__init__(config, tool='synccheck')
 
 
+class TestMemcheckBatchCommand(TestMemcheckCommandBase):
+    """
+    Runs the tests with several cuda-memcheck tools at the same time, using
+    a single compilation of the binary. The results of each tool are reported
+    as if the corresponding test-memcheck-* command had been run.
+
+    Like in those commands, each tool runs the tests one at a time, but the
+    tools run concurrently, so the GPU is shared by one process per tool.
+    This trades some accuracy of the timeouts for a shorter wall time, which
+    is why it is only used when asked for with --batch-memcheck. A test that
+    is close to its timeout may time out here even if it passes with the
+    separate commands.
+    """
+    name = 'test-memcheck-batch'
+    help = 'run all memcheck-* commands (except racecheck) at the same time'
+    tools = ['memcheck', 'initcheck', 'synccheck']
+
+    def __init__(self, config: Config):
+        super().__init__(config, tool=self.tools[0])
+
+    def query_timeout(self, tests: List[str], timeout: Optional[float],
+                      no_timeout: Optional[bool]) -> float:
+        # 10s additional timeout for compilation
+        return compile_timeout(10, no_timeout) + len(
+            self.tools) * timeout_for_test_set(self.collect_tests(tests),
+                                               timeout, no_timeout,
+                                               self.extra_timeout)
+
+    def _exec_rest(self, compiler: Optional[Compiler], reporter: Reporter,
+                   tests: List[str], timeout: Optional[float],
+                   no_timeout: Optional[bool]) -> bool:
+        runners = [MemcheckRunner(tool) for tool in self.tools]
+        compiler = self._prepare_compiler(self.config.common_flags(compiler),
+                                          runners[0])
+        tests = self.collect_tests(tests)
+        timeouts = [
+            parse_timeout(test, timeout, no_timeout, self.extra_timeout)
+            for test in tests
+        ]
+        results = [[Future() for _ in tests] for _ in self.tools]
+
+        output = None
+        with ThreadPoolExecutor(max_workers=len(self.tools)) as executor:
+            try:
+                for tool, tool_results in zip(self.tools, results):
+                    if output is not None:
+                        reporter.log(
+                            f'Running tests with cuda-memcheck --tool {tool}',
+                            'title')
+                    rep = reporter.test_group(f'test-memcheck-{tool}', tests)
+                    if output is None:
+                        output = rep.compilation(
+                            compiler.add_source(self.config.tester).add_source(
+                                self.config.source)).compile(
+                                    out_file=self.config.binary,
+                                    timeout=compile_timeout(10, no_timeout))
+                        if not output.is_success():
+                            return False
+
+                        # The binary is ready, so every tool can start
+                        # running the tests
+                        for runner, shard in zip(runners, results):
+                            executor.submit(
+                                self._run_shard, runner, FirstFailure(),
+                                list(
+                                    zip(range(len(tests)), tests, timeouts,
+                                        shard)))
+                    else:
+                        rep.reused_compilation(_BuiltBinary(output)).compile()
+
+                    for result in tool_results:
+                        test, runner_output = result.result()
+                        rep.result(test, runner_output)
+                        if self._stops_run(runner_output):
+                            return False
+            finally:
+                # Don't start the remaining tests if we stopped early
+                for tool_results in results:
+                    for pending in tool_results:
+                        pending.cancel()
+
+        return True
+
+
+class _BuiltBinary:
+    """
+    Stands in for the compiler of an already built binary, so that the same
+    compilation can be reported in several test groups.
+    """
+    def __init__(self, output: CompilerOutput):
+        self.output = output
+
+    def compile(self, *args, **kwargs) -> CompilerOutput:
+        return self.output
+
+
 class TestUninitCommand(TestCommandBase):
     start_message = 'Running tests with uninitialized variable check'
     name = 'test-uninit'
@@ -286,8 +493,8 @@ class TestUninitCommand(TestCommandBase):
 
     def _prepare_compiler(self, compiler: Compiler,
                           runner: Runner) -> Compiler:
-        return compiler.add_flag('-O3').add_flag('-g').add_flag(
-            '-ftrivial-auto-var-init=pattern')
+        return compiler.add_flag('-O3', '-g',
+                                 '-ftrivial-auto-var-init=pattern')
 
     def exec(self, compiler: Optional[Compiler], reporter: Reporter,
              tests: List[str], timeout: Optional[float],
@@ -377,7 +584,7 @@ class BenchmarkCommand(BenchmarkCommandBase):
 
     def _prepare_compiler(self, compiler: Compiler,
                           runner: Runner) -> Compiler:
-        return compiler.add_flag('-O3').add_flag('-g')
+        return compiler.add_flag('-O3', '-g')
 
 
 class BenchmarkCacheCommand(BenchmarkCommandBase):
@@ -391,7 +598,7 @@ class BenchmarkCacheCommand(BenchmarkCommandBase):
 
     def _prepare_compiler(self, compiler: Compiler,
                           runner: Runner) -> Compiler:
-        return compiler.add_flag('-O3').add_flag('-g')
+        return compiler.add_flag('-O3', '-g')
 
 
 class AssemblyCommandBase(Command):
@@ -416,14 +623,19 @@ class AssemblyCommandBase(Command):
             return False
 
         assembly = self._extract_assembly()
-        if len(assembly.encode('utf-8')) > MAX_ASSEMBLY_OUTPUT:
-            assembly = "Generated assembly was too long and wasn't stored"
-        rep.analyze(assembly)
+        if assembly is None or len(assembly) > MAX_ASSEMBLY_OUTPUT:
+            rep.analyze("Generated assembly was too long and wasn't stored")
+        else:
+            rep.analyze(assembly.decode('utf-8', errors='replace'))
 
         return True
 
-    def _extract_assembly(self) -> str:
-        return Path(self.config.binary).read_text()
+    def _extract_assembly(self) -> Optional[bytes]:
+        """Returns the generated assembly, or None if it is too long"""
+        if os.path.getsize(self.config.binary) > MAX_ASSEMBLY_OUTPUT:
+            return None
+        with open(self.config.binary, 'rb') as f:
+            return read_bounded(f, MAX_ASSEMBLY_OUTPUT)
 
     def _set_compile_flags(self, compiler: Compiler) -> Compiler:
         raise NotImplementedError()
@@ -448,26 +660,31 @@ class AssemblyCPUCommand(AssemblyCommandBase):
             return self.config.common_flags(compiler).add_flag(
                 '-O3', '-S', '-fverbose-asm')
 
-    def _extract_assembly(self) -> str:
-        raw = Path(self.config.binary).read_text()
+    def _extract_assembly(self) -> Optional[bytes]:
         if self.config.gpu:
             filtered = []
+            size = 0
             keep = True
-            for line in raw.splitlines():
-                # skip all lines in the .fatbin section for cuda
-                # host-side assembly
-                if not keep:
-                    if line.startswith('.quad'):
-                        continue
-                keep = True
-                filtered.append(line)
-                if line.startswith('fatbinData:'):
-                    filtered.append('# [...] omitted')
-                    keep = False
-
-            return '\n'.join(filtered)
+            with open(self.config.binary, 'rb') as f:
+                for line in f:
+                    line = line.rstrip(b'\r\n')
+                    # skip all lines in the .fatbin section for cuda
+                    # host-side assembly
+                    if not keep:
+                        if line.startswith(b'.quad'):
+                            continue
+                    keep = True
+                    filtered.append(line)
+                    size += len(line) + 1
+                    if line.startswith(b'fatbinData:'):
+                        filtered.append(b'# [...] omitted')
+                        keep = False
+                    if size > MAX_ASSEMBLY_OUTPUT:
+                        return None
+
+            return b'\n'.join(filtered)
         else:
-            return raw
+            return super()._extract_assembly()
 
 
 class AssemblyPTXCommand(AssemblyCommandBase):
@@ -486,13 +703,21 @@ class AssemblySASSCommand(AssemblyCommandBase):
     def _set_compile_flags(self, compiler: Compiler) -> Compiler:
         return self.config.common_flags(compiler).add_flag('-cubin')
 
-    def _extract_assembly(self) -> str:
+    def _extract_assembly(self) -> Optional[bytes]:
         # --no-vliw: Conventional mode; disassemble paired instructions in normal syntax
         args = [
             "nvdisasm", "--life-range-mode", "count", "--no-vliw",
             self.config.binary
         ]
-        return subprocess.check_output(args, encoding="utf-8")
+        with subprocess.Popen(args, stdout=subprocess.PIPE) as process:
+            raw = read_bounded(process.stdout, MAX_ASSEMBLY_OUTPUT)
+            if raw is None:
+                # No need to wait for the rest of the output
+                process.kill()
+                return None
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args)
+        return raw
 
 
 class CompileCommandBase(Command):
@@ -535,7 +760,7 @@ class CompileCommand(CompileCommandBase):
     help = 'compile a binary with full optimizations for profiling'
 
     def _prepare_compiler(self, compiler: Compiler) -> Compiler:
-        return compiler.add_flag('-O3').add_flag('-g')
+        return compiler.add_flag('-O3', '-g')
 
 
 class DemoCommandBase(Command):
@@ -622,6 +847,31 @@ class CompileDebugCommand(CompileCommandBase):
         return compiler.add_flag('-g')
 
 
+# Timeouts of test files are cached for the duration of a single grader run,
+# as the same tests are usually run by several commands
+_file_timeouts: Dict[str, Optional[float]] = {}
+
+
+def _read_timeout(file: str) -> Optional[float]:
+    """Reads the timeout from the first line of a test file"""
+    # The timeout line is always short, so there is no need to read the
+    # whole file
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        head = os.read(fd, 64)
+    finally:
+        os.close(fd)
+
+    first_line = head.split(b'\n', 1)[0].split(b' ')
+    if first_line[0] == b"timeout":
+        try:
+            return float(first_line[1])
+        except (ValueError, IndexError):
+            # Results are cached, so this is printed only once per file
+            print(f'Ignoring malformed timeout in {file}', file=sys.stderr)
+    return None
+
+
 def parse_timeout(file: str,
                   timeout: Optional[float],
                   no_timeout: Optional[bool],
@@ -640,13 +890,15 @@ def parse_timeout(file: str,
     if timeout:
         return timeout
 
-    first_line = open(file, 'r').readline().split(' ')
-    if first_line[0] == "timeout":
-        if extra_timeout is not None:
-            return float(first_line[1]) + extra_timeout
-        else:
-            return float(first_line[1])
-    return None
+    if file not in _file_timeouts:
+        _file_timeouts[file] = _read_timeout(file)
+    file_timeout = _file_timeouts[file]
+    if file_timeout is None:
+        return None
+    if extra_timeout is not None:
+        return file_timeout + extra_timeout
+    else:
+        return file_timeout
 
 
 def timeout_for_test_set(files: List[str], timeout: Optional[float],
@@ -670,20 +922,76 @@ def compile_timeout(timeout: float, no_timeout: Optional[bool]) -> float:
     return 10
 
 
+# Directory listings are cached for the duration of a single grader run.
+# They are kept sorted, so that filtering them keeps the matches in order.
+_directory_listings: Dict[str, List[str]] = {}
+
+
+def _list_directory(directory: str) -> List[str]:
+    if directory not in _directory_listings:
+        try:
+            with os.scandir(directory) as entries:
+                _directory_listings[directory] = sorted(
+                    entry.name for entry in entries)
+        except OSError:
+            _directory_listings[directory] = []
+    return _directory_listings[directory]
+
+
+@functools.lru_cache(maxsize=128)
+def _compiled_pattern(pattern: str) -> 're.Pattern[str]':
+    return re.compile(fnmatch.translate(pattern))
+
+
+def _has_magic(pattern: str) -> bool:
+    return any(c in pattern for c in '*?[')
+
+
+def _match_glob(pattern: str) -> List[str]:
+    directory, name_pattern = os.path.split(pattern)
+    if _has_magic(directory):
+        # Wildcards in the directory part need a full directory walk
+        return sorted(glob.glob(pattern))
+
+    names = _list_directory(directory or os.curdir)
+    if not name_pattern.startswith('.'):
+        # Like glob, match hidden files only if explicitly asked for
+        names = [name for name in names if not name.startswith('.')]
+    match = _compiled_pattern(name_pattern).match
+    return [os.path.join(directory, name) for name in names if match(name)]
+
+
 def expand_glob(globs: List[str], default: List[str]) -> List[str]:
     """Expand glob of tests, defaulting to default if no globs were provided"""
     if not globs:
         globs = default
     tests = []
     for pattern in globs:
-        if os.path.exists(pattern):
+        if os.path.lexists(pattern):
             tests.append(pattern)
-        else:
-            tests.extend(sorted(glob.glob(pattern)))
+        elif _has_magic(pattern):
+            tests.extend(_match_glob(pattern))
+        # A literal path that doesn't exist matches nothing, so there is no
+        # need to list its directory
 
     return tests
 
 
+def read_bounded(stream, limit: int) -> Optional[bytes]:
+    """
+    Reads `stream` until the end, or returns None as soon as more than `limit`
+    bytes have been read.
+    """
+    data = bytearray()
+    while True:
+        chunk = stream.read(ASSEMBLY_READ_CHUNK)
+        if not chunk:
+            return bytes(data)
+        data += chunk
+        if len(data) > limit:
+            return None
+
+
 def no_tests_error(orig_tests: List[str], dirs: List[str]):
     if orig_tests:
         quote = '"'
@@ -721,4 +1029,5 @@ COMMANDS = [
     TestRacecheckCommand,
     TestInitcheckCommand,
     TestSynccheckCommand,
+    TestMemcheckBatchCommand,
 ]
@@ -0,0 +1,127 @@
+import functools
+import hashlib
+import json
+import os
+import platform
+import shutil
+import tempfile
+from typing import Callable, List, Optional, Tuple
+
+# Bump this whenever the way compilers are probed changes, so that records
+# written by older versions of the grader are not used anymore
+SCHEMA_VERSION = 2
+
+
+class ProbeRecord:
+    def __init__(self,
+                 family: str,
+                 version: Optional[Tuple[int, int, int]],
+                 apple: Optional[bool] = None):
+        self.family = family
+        self.version = version
+        self.apple = apple
+
+
+@functools.lru_cache(maxsize=None)
+def which(program: str) -> Optional[str]:
+    """
+    Like shutil.which, but cached, as the same candidate programs are looked
+    up several times when searching for compilers
+    """
+    return shutil.which(program)
+
+
+def get_cache_path() -> str:
+    path = os.getenv('XDG_CACHE_HOME')
+    if path is not None:
+        path = os.path.join(path, 'ppcgrader/')
+    else:
+        if platform.system() == 'Darwin':
+            path = os.path.expanduser('~/Library/Caches/ppcgrader/')
+        else:
+            path = os.path.expanduser('~/.cache/ppcgrader/')
+    return os.path.join(path, 'compiler-probes')
+
+
+def _fingerprint(path: str) -> List[int]:
+    # Any update of the compiler binary changes at least one of these
+    st = os.stat(path)
+    return [
+        st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+    ]
+
+
+def _record_file(family: str, path: str) -> str:
+    name = hashlib.sha256(f'{family}\0{path}'.encode('utf-8')).hexdigest()
+    return os.path.join(get_cache_path(), f'{name}.json')
+
+
+def _load(file: str, family: str,
+          fingerprint: List[int]) -> Optional[ProbeRecord]:
+    with open(file, 'r') as f:
+        data = json.load(f)
+    if (data['schema_version'] != SCHEMA_VERSION
+            or data['family'] != family
+            or data['fingerprint'] != fingerprint):
+        return None
+    version = data['version']
+    return ProbeRecord(family,
+                       tuple(int(v) for v in version)
+                       if version is not None else None, data['apple'])
+
+
+def _store(file: str, record: ProbeRecord, fingerprint: List[int]):
+    data = {
+        'schema_version': SCHEMA_VERSION,
+        'family': record.family,
+        'fingerprint': fingerprint,
+        'version': record.version,
+        'apple': record.apple,
+    }
+    directory = os.path.dirname(file)
+    os.makedirs(directory, exist_ok=True)
+    # Write to a temporary file first so that concurrent graders never see
+    # a partially written record
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, file)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def probe(program: str, family: str,
+          detect: Callable[[str], ProbeRecord]) -> ProbeRecord:
+    """
+    Probes the compiler `program` with `detect`, reusing the result of an
+    earlier probe of the very same binary if one has been stored.
+
+    Problems with the stored records are never fatal; in the worst case the
+    compiler is just probed again.
+    """
+    path = which(program)
+    if path is None:
+        return detect(program)
+
+    try:
+        fingerprint = _fingerprint(path)
+    except OSError:
+        return detect(program)
+
+    file = _record_file(family, path)
+    try:
+        record = _load(file, family, fingerprint)
+        if record is not None:
+            return record
+    except (OSError, ValueError, KeyError, TypeError):
+        # The record is missing or broken
+        pass
+
+    record = detect(program)
+    try:
+        _store(file, record, fingerprint)
+    except OSError:
+        pass
+    return record
@@ -1,6 +1,6 @@
 import os
 from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
-from ppcgrader.compiler import Compiler, find_clang_compiler, find_gcc_compiler, find_nvcc_compiler
+from ppcgrader.compiler import Compiler, NvccCompiler, find_clang_compiler, find_compiler_cache, find_gcc_compiler, find_nvcc_compiler
 from ppcgrader.runner import RunnerOutput
 from ppcgrader.api_tools import EnvProperty, get_home_config_path, load_json_config
 
@@ -35,6 +35,8 @@ class Config:
         self.openmp: bool = openmp
         self.ignore_errors: bool
         self.nvprof: bool = False
+        self.parallel: int = 1
+        self.ccache: bool = False
         self.export_streams: bool = False
         self.on_remote: bool
         self.test_flag = '--test'
@@ -72,15 +74,20 @@ class Config:
             os.path.normpath(os.path.join(os.path.dirname(__file__),
                                           'include'))
         ]
+        include_flag = '-I' if self.gpu else '-iquote'
+        flags = []
         for include_path in include_paths:
-            if self.gpu:
-                compiler = compiler.add_flag('-I', include_path)
-            else:
-                compiler = compiler.add_flag('-iquote', include_path)
+            flags += [include_flag, include_path]
+        compiler = compiler.add_flag(*flags)
 
         if self.openmp:
             compiler = compiler.add_omp_flags()
 
+        if self.ccache and not isinstance(compiler, NvccCompiler):
+            cache = find_compiler_cache()
+            if cache is not None:
+                compiler = compiler.with_cache(cache)
+
         return compiler
 
     def demo_flags(self, compiler: Compiler) -> Compiler:
@@ -19,9 +19,10 @@ class Logger:
         if self.enabled and self.level >= level:
             msg = '>> ' + shlex_join(args)
             if self.color:
-                print('\033[34m' + msg + '\033[0m', flush=True)
-            else:
-                print(msg, flush=True)
+                msg = '\033[34m' + msg + '\033[0m'
+            # Commands may be logged from multiple threads at once. Write the
+            # line with a single call so it doesn't get mixed with the others.
+            print(msg + '\n', end='', flush=True)
             return True
         else:
             return False
@@ -23,7 +23,10 @@ def collect_args(args: Namespace, tests: List[str],
     commands = []
 
     for arg, value in args.__dict__.items():
-        if arg in ['help', 'binary', 'remote', 'query_timeout']:
+        if arg in [
+                'help', 'binary', 'remote', 'query_timeout', 'parallel',
+                'ccache', 'batch_memcheck'
+        ]:
             # Ignore silently
             pass
 
@@ -99,6 +99,14 @@ class Reporter:
                         compiler: Compiler) -> 'Reporter.CompilationProxy':
             raise NotImplementedError()
 
+        def reused_compilation(
+                self, compiler: Compiler) -> 'Reporter.CompilationProxy':
+            """
+            Like compilation, but for a binary that was already compiled and
+            reported in another group
+            """
+            return self.compilation(compiler)
+
         def result(self, test: str, output: RunnerOutput):
             raise NotImplementedError()
 
@@ -281,6 +289,11 @@ class TerminalReporter(Reporter):
                         compiler: Compiler) -> 'Reporter.CompilationProxy':
             return TerminalReporter.CompilationProxy(self.reporter, compiler)
 
+        def reused_compilation(
+                self, compiler: Compiler) -> 'Reporter.CompilationProxy':
+            return TerminalReporter.ReusedCompilationProxy(
+                self.reporter, compiler)
+
         def _handle_result(self, test: str, output: RunnerOutput):
             raise NotImplementedError()
 
@@ -398,6 +411,17 @@ class TerminalReporter(Reporter):
                 else:
                     break
 
+    class ReusedCompilationProxy(Reporter.CompilationProxy):
+        def __init__(self, reporter: 'TerminalReporter', compiler: Compiler):
+            self.reporter = reporter
+            self.compiler = compiler
+
+        def compile(self, *args, **kwargs) -> 'CompilerOutput':
+            # The compiler output was already shown with the first group
+            result = self.compiler.compile(*args, **kwargs)
+            self.reporter.log('Reusing the binary compiled above')
+            return result
+
     def __init__(self, config: Config, color: Optional[bool] = None):
         super().__init__(config)
         self.color = sys.stdout.isatty() if color is None else color
@@ -430,7 +454,9 @@ class TerminalReporter(Reporter):
                 'command': ('\033[34m', reset),
                 'output': ('\033[34m', reset),
             }.get(kind, ('', ''))
-        print(before + msg + after)
+        # Written with a single call, so the commands logged by the tests
+        # running in the background don't end up in the middle of the line
+        print(before + msg + after + '\n', end='')
         self.sep_printed = False
 
     def finalize(self):
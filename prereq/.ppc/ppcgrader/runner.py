@@ -105,6 +105,11 @@ class Runner:
         env['PPC_PERF'] = measure
 
         logged = log_command(args)
+        # Tests are run many times, possibly from several threads, so keep the
+        # process creation cheap: on Linux, Python 3.10+ starts the process
+        # with vfork instead of fork, without copying the page tables of the
+        # grader, unless preexec_fn, user, group or extra_groups is given. The
+        # same applies to the other runners.
         process = subprocess.Popen(args,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE,